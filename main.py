@@ -1,13 +1,25 @@
+import asyncio
+import logging
 import os
+import time
+from decimal import ROUND_HALF_UP, Decimal
 from datetime import datetime, timezone
 from typing import Optional
 
+import bcrypt
+import jwt
+import orjson
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
+import bson
 from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
 
-from database import db, create_document, get_documents
+from database import client, db, create_document, get_documents
 from schemas import (
     RegisterRequest, LoginRequest,
     StartSessionRequest, EndSessionRequest,
@@ -17,7 +29,35 @@ from schemas import (
     Cafe, User, Station, Session, MenuItem, Order, OrderItem, Payment, Settings, KDSUpdate, Notification, AuditLog
 )
 
-app = FastAPI()
+class MongoORJSONResponse(ORJSONResponse):
+    """ORJSONResponse that falls back to str() for BSON types (ObjectId)."""
+
+    def render(self, content) -> bytes:
+        # OPT_NAIVE_UTC: Motor hands back BSON dates as naive datetimes; they
+        # are UTC and must serialize with the +00:00 offset.
+        return orjson.dumps(content, default=str,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC)
+
+
+app = FastAPI(default_response_class=MongoORJSONResponse)
+
+
+def stream_json_array(cursor) -> StreamingResponse:
+    """Stream a cursor as a JSON array, one orjson-encoded document at a time.
+
+    Keeps list endpoints at O(1) memory instead of materializing the whole
+    result before serialization."""
+    async def gen():
+        yield b"["
+        first = True
+        async for doc in cursor:
+            if first:
+                first = False
+            else:
+                yield b","
+            yield orjson.dumps(doc, default=str, option=orjson.OPT_NAIVE_UTC)
+        yield b"]"
+    return StreamingResponse(gen(), media_type="application/json")
 
 app.add_middleware(
     CORSMiddleware,
@@ -29,104 +69,286 @@ app.add_middleware(
 
 # Helpers
 
+_CENTS = Decimal("0.01")
+
+
+def _money(value) -> Decimal:
+    """Exact Decimal for a stored price/rate (via str to avoid float artifacts)."""
+    return Decimal(str(value))
+
+
 def oid(id_str: str) -> ObjectId:
-    try:
-        return ObjectId(id_str)
-    except Exception:
+    if not ObjectId.is_valid(id_str):
         raise HTTPException(status_code=400, detail="Invalid ID")
+    return ObjectId(id_str)
+
+
+def now_utc() -> datetime:
+    # Stored as native BSON dates (8 bytes, no string formatting); serialized
+    # back to ISO at the JSON edge by orjson.
+    return datetime.now(timezone.utc)
+
 
+# Auth: bcrypt for stored password hashes (checked off the event loop),
+# HS256 JWTs so authenticated requests skip the bcrypt cost entirely.
+JWT_SECRET = os.getenv("JWT_SECRET", "change-me-in-production")
+JWT_TTL_SECONDS = 12 * 3600
+TOKEN_CACHE_TTL = 60.0  # seconds; never extends past the token's own exp
+TOKEN_CACHE_MAX = 4096
+_token_cache: dict = {}  # token -> (expires_at_epoch, user_id)
 
-def now_iso():
-    return datetime.now(timezone.utc).isoformat()
+
+def _issue_token(user_id: str) -> str:
+    now = int(time.time())
+    return jwt.encode({"sub": user_id, "iat": now, "exp": now + JWT_TTL_SECONDS}, JWT_SECRET, algorithm="HS256")
+
+
+def verify_token(token: str) -> str:
+    """Return the user_id for a valid token, caching verified tokens."""
+    now = time.time()
+    hit = _token_cache.get(token)
+    if hit and now < hit[0]:
+        return hit[1]
+    try:
+        claims = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
+    except jwt.InvalidTokenError:
+        raise HTTPException(401, "Invalid or expired token")
+    user_id = claims["sub"]
+    if len(_token_cache) >= TOKEN_CACHE_MAX:
+        for key, (expires_at, _) in list(_token_cache.items()):
+            if now >= expires_at:
+                del _token_cache[key]
+        while len(_token_cache) >= TOKEN_CACHE_MAX:
+            # Still full of live entries: drop the oldest-inserted ones.
+            del _token_cache[next(iter(_token_cache))]
+    _token_cache[token] = (min(now + TOKEN_CACHE_TTL, float(claims["exp"])), user_id)
+    return user_id
+
+
+# Settings change rarely but are read on every order; cache them per cafe
+# for a short TTL and invalidate on update_settings.
+SETTINGS_CACHE_TTL = 30.0  # seconds
+_settings_cache: dict = {}
+
+
+async def get_cached_settings(cafe_id: str) -> dict:
+    hit = _settings_cache.get(cafe_id)
+    if hit and time.monotonic() - hit[0] < SETTINGS_CACHE_TTL:
+        return hit[1]
+    s = await db.settings.find_one({"cafe_id": cafe_id}) or {"tax_rate": 0.0}
+    _settings_cache[cafe_id] = (time.monotonic(), s)
+    return s
+
+
+# Audit writes are enqueued and flushed in bulk off the request path so
+# mutating endpoints don't pay a second write round-trip.
+AUDIT_FLUSH_INTERVAL = 0.25  # seconds
+AUDIT_FLUSH_MAX_BATCH = 500
+_audit_queue: "asyncio.Queue[dict]" = asyncio.Queue()
+_audit_flusher_task: Optional[asyncio.Task] = None
 
 
 def audit(action: str, table: str, record_id: Optional[str], payload: Optional[dict], user_id: Optional[str] = None, cafe_id: Optional[str] = None):
     try:
-        create_document("auditlog", AuditLog(
+        entry = AuditLog(
             user_id=user_id,
             cafe_id=cafe_id,
             action=action,
             table=table,
             record_id=record_id,
-            payload=payload or {}
-        ))
+            payload={}
+        ).model_dump(exclude_none=True)
+        # Encode the payload to BSON once here; insert_many then splices the
+        # raw bytes instead of walking the dict a second time.
+        entry["payload"] = RawBSONDocument(bson.encode(payload or {}))
+        entry["created_at"] = entry["updated_at"] = now_utc()
+        _audit_queue.put_nowait(entry)
     except Exception:
         pass
 
 
+async def _drain_audit_batch() -> list:
+    batch = [await _audit_queue.get()]
+    await asyncio.sleep(AUDIT_FLUSH_INTERVAL)
+    while not _audit_queue.empty() and len(batch) < AUDIT_FLUSH_MAX_BATCH:
+        batch.append(_audit_queue.get_nowait())
+    return batch
+
+
+async def _flush_audit_queue():
+    while True:
+        batch = await _drain_audit_batch()
+        try:
+            await db.auditlog.insert_many(batch, ordered=False)
+        except Exception:
+            pass
+
+
+@app.on_event("startup")
+async def start_audit_flusher():
+    global _audit_flusher_task
+    if db is not None and _audit_flusher_task is None:
+        _audit_flusher_task = asyncio.create_task(_flush_audit_queue())
+
+
+@app.on_event("shutdown")
+async def stop_audit_flusher():
+    global _audit_flusher_task
+    if _audit_flusher_task is not None:
+        _audit_flusher_task.cancel()
+        _audit_flusher_task = None
+    if db is not None and not _audit_queue.empty():
+        leftovers = []
+        while not _audit_queue.empty():
+            leftovers.append(_audit_queue.get_nowait())
+        try:
+            await db.auditlog.insert_many(leftovers, ordered=False)
+        except Exception:
+            pass
+
+
+# Multi-document transactions need a replica set / mongos; probed once at
+# startup so checkout can fall back to un-transacted writes on standalone.
+_txn_supported = False
+
+
+@app.on_event("startup")
+async def probe_transaction_support():
+    global _txn_supported
+    if client is None:
+        return
+    try:
+        async with await client.start_session() as s:
+            async with s.start_transaction():
+                await db.payment.find_one({}, session=s)
+        _txn_supported = True
+    except PyMongoError as exc:
+        # Standalone server, or the database is unreachable at boot — either
+        # way checkout runs un-transacted; don't block startup.
+        _txn_supported = False
+        logging.getLogger(__name__).warning("transaction support probe failed: %s", exc)
+
+
+@app.on_event("startup")
+async def create_indexes():
+    if db is None:
+        return
+    # Compound indexes backing the hot list/filter queries; create_index is a
+    # no-op when the index already exists. Index trouble (legacy duplicate
+    # keys, database unreachable at boot) is logged, never fatal: the app
+    # serves without the indexes until a later boot can build them.
+    try:
+        await db.order.create_index([("cafe_id", 1), ("status", 1), ("created_at", -1)])
+        await db.session.create_index([("cafe_id", 1), ("status", 1), ("created_at", -1)])
+        await db.menuitem.create_index([("cafe_id", 1), ("is_active", 1)])
+        await db.payment.create_index(
+            "idempotency_key", unique=True,
+            partialFilterExpression={"idempotency_key": {"$type": "string"}},
+        )
+    except PyMongoError as exc:
+        logging.getLogger(__name__).warning("index creation skipped: %s", exc)
+
+
 @app.get("/")
 def read_root():
     return {"message": "Gamifisys POS+KDS Backend (MongoDB)"}
 
 
 @app.get("/test_database")
-def test_database():
+async def test_database():
     if db is None:
         return {"backend": "running", "database": "not-configured"}
     return {
         "backend": "running",
         "database": "connected",
-        "collections": db.list_collection_names(),
+        "collections": await db.list_collection_names(),
     }
 
 
-# Auth (simple email+password hash placeholder for demo). In production use a proper auth provider.
+# Auth: bcrypt-hashed passwords, JWT session tokens.
 @app.post("/auth/register")
-def register(req: RegisterRequest):
-    existing = db.user.find_one({"email": req.email})
+async def register(req: RegisterRequest):
+    existing = await db.user.find_one({"email": req.email})
     if existing:
         raise HTTPException(400, "Email already registered")
+    hashed = await run_in_threadpool(bcrypt.hashpw, req.password.encode(), bcrypt.gensalt())
     user = User(
         email=req.email,
-        password_hash=req.password,  # NOTE: replace with proper hashing in production
+        password_hash=hashed.decode(),
         name=req.name,
         role=req.role,
         is_active=True,
     )
-    uid = create_document("user", user)
-    audit("create", "user", uid, user.model_dump())
+    uid = await create_document("user", user)
+    audit("create", "user", uid, user.model_dump(exclude={"password_hash"}))
     return {"user_id": uid}
 
 
 @app.post("/auth/login")
-def login(req: LoginRequest):
-    user = db.user.find_one({"email": req.email, "password_hash": req.password, "is_active": True})
+async def login(req: LoginRequest):
+    user = await db.user.find_one({"email": req.email, "is_active": True})
     if not user:
         raise HTTPException(401, "Invalid credentials")
-    return {"user_id": str(user["_id"]), "name": user.get("name"), "role": user.get("role")}
+    stored = user.get("password_hash", "")
+    if stored.startswith("$2"):
+        ok = await run_in_threadpool(bcrypt.checkpw, req.password.encode(), stored.encode())
+    else:
+        # Legacy plaintext record: verify and upgrade to bcrypt in place.
+        ok = stored == req.password
+        if ok:
+            hashed = await run_in_threadpool(bcrypt.hashpw, req.password.encode(), bcrypt.gensalt())
+            await db.user.update_one({"_id": user["_id"]}, {"$set": {"password_hash": hashed.decode()}})
+    if not ok:
+        raise HTTPException(401, "Invalid credentials")
+    uid = str(user["_id"])
+    return {"user_id": uid, "name": user.get("name"), "role": user.get("role"), "token": _issue_token(uid)}
+
+
+@app.get("/auth/me")
+async def auth_me(token: str):
+    user_id = verify_token(token)
+    user = await db.user.find_one({"_id": oid(user_id)}, projection={"password_hash": 0})
+    if not user:
+        raise HTTPException(404, "User not found")
+    user["_id"] = str(user["_id"])
+    return user
 
 
 # Stations
 @app.get("/stations")
-def fetch_stations(cafe_id: Optional[str] = None):
+async def fetch_stations(cafe_id: Optional[str] = None):
     q = {"cafe_id": cafe_id} if cafe_id else {}
-    items = list(db.station.find(q))
-    for x in items:
-        x["_id"] = str(x["_id"]) 
-    return items
+    projection = {"cafe_id": 1, "name": 1, "status": 1, "current_session_id": 1}
+    return stream_json_array(db.station.aggregate([
+        {"$match": q},
+        {"$project": projection},
+        {"$addFields": {"_id": {"$toString": "$_id"}}},
+    ]))
 
 
 @app.post("/stations")
-def create_station(station: Station):
-    sid = create_document("station", station)
+async def create_station(station: Station):
+    sid = await create_document("station", station)
     audit("create", "station", sid, station.model_dump(), cafe_id=station.cafe_id)
     return {"station_id": sid}
 
 
 @app.post("/stations/status")
-def update_station_status(req: UpdateStationStatusRequest):
-    st = db.station.find_one({"_id": oid(req.station_id)})
+async def update_station_status(req: UpdateStationStatusRequest):
+    station_id = oid(req.station_id)
+    st = await db.station.find_one({"_id": station_id})
     if not st:
         raise HTTPException(404, "Station not found")
-    db.station.update_one({"_id": oid(req.station_id)}, {"$set": {"status": req.status, "updated_at": datetime.now(timezone.utc)}})
+    await db.station.update_one({"_id": station_id}, {"$set": {"status": req.status, "updated_at": now_utc()}})
     audit("update", "station", req.station_id, {"status": req.status}, cafe_id=st.get("cafe_id"))
     return {"ok": True}
 
 
 # Sessions
 @app.post("/sessions/start")
-def start_session(req: StartSessionRequest):
-    st = db.station.find_one({"_id": oid(req.station_id)})
+async def start_session(req: StartSessionRequest):
+    station_id = oid(req.station_id)
+    st = await db.station.find_one({"_id": station_id})
     if not st:
         raise HTTPException(404, "Station not found")
     if st.get("status") == "in-use":
@@ -137,135 +359,207 @@ def start_session(req: StartSessionRequest):
         station_id=req.station_id,
         status="active",
         customer_name=req.customer_name,
-        started_at=now_iso(),
+        started_at=now_utc(),
     )
-    sid = create_document("session", session)
-    db.station.update_one({"_id": oid(req.station_id)}, {"$set": {"status": "in-use", "current_session_id": sid}})
+    sid = await create_document("session", session)
+    await db.station.update_one({"_id": station_id}, {"$set": {"status": "in-use", "current_session_id": sid}})
     audit("create", "session", sid, session.model_dump(), cafe_id=req.cafe_id)
     return {"session_id": sid}
 
 
 @app.post("/sessions/end")
-def end_session(req: EndSessionRequest):
-    sess = db.session.find_one({"_id": oid(req.session_id)})
+async def end_session(req: EndSessionRequest):
+    # Atomically read and end the session in one round-trip.
+    session_id = oid(req.session_id)
+    sess = await db.session.find_one_and_update(
+        {"_id": session_id, "status": {"$ne": "ended"}},
+        {"$set": {"status": "ended", "ended_at": now_utc()}},
+    )
     if not sess:
+        # Cold path only: distinguish "already ended" from "not found".
+        if await db.session.find_one({"_id": session_id}, projection={"_id": 1}):
+            return {"ok": True}
         raise HTTPException(404, "Session not found")
-    if sess.get("status") == "ended":
-        return {"ok": True}
 
-    db.session.update_one({"_id": oid(req.session_id)}, {"$set": {"status": "ended", "ended_at": now_iso()}})
-    db.station.update_one({"_id": oid(sess["station_id"])}, {"$set": {"status": "available", "current_session_id": None}})
+    await db.station.update_one({"_id": oid(sess["station_id"])}, {"$set": {"status": "available", "current_session_id": None}})
     audit("update", "session", req.session_id, {"status": "ended"}, cafe_id=sess.get("cafe_id"))
     return {"ok": True}
 
 
 @app.get("/sessions")
-def fetch_sessions(cafe_id: Optional[str] = None, status: Optional[str] = None):
+async def fetch_sessions(cafe_id: Optional[str] = None, status: Optional[str] = None):
     q = {}
     if cafe_id:
         q["cafe_id"] = cafe_id
     if status:
         q["status"] = status
-    items = list(db.session.find(q).sort("created_at", -1).limit(100))
-    for x in items:
-        x["_id"] = str(x["_id"]) 
-    return items
+    projection = {
+        "cafe_id": 1, "station_id": 1, "customer_name": 1, "status": 1,
+        "started_at": 1, "ended_at": 1, "duration_minutes": 1, "total_amount": 1,
+        "created_at": 1,
+    }
+    # batchSize matches the limit so results arrive in a single reply; hint
+    # pins the compound index whenever its cafe_id prefix is bound.
+    kwargs = {"batchSize": 100}
+    if cafe_id:
+        kwargs["hint"] = {"cafe_id": 1, "status": 1, "created_at": -1}
+    return stream_json_array(db.session.aggregate([
+        {"$match": q},
+        {"$sort": {"created_at": -1}},
+        {"$limit": 100},
+        {"$project": projection},
+        {"$addFields": {"_id": {"$toString": "$_id"}}},
+    ], **kwargs))
 
 
 # Menu
 @app.get("/menu")
-def fetch_menu(cafe_id: Optional[str] = None):
+async def fetch_menu(cafe_id: Optional[str] = None):
     q = {"cafe_id": cafe_id} if cafe_id else {}
-    items = list(db.menuitem.find(q))
-    for x in items:
-        x["_id"] = str(x["_id"]) 
-    return items
+    projection = {"cafe_id": 1, "name": 1, "category": 1, "price": 1, "sku": 1, "is_active": 1}
+    return stream_json_array(db.menuitem.aggregate([
+        {"$match": q},
+        {"$project": projection},
+        {"$addFields": {"_id": {"$toString": "$_id"}}},
+    ]))
 
 
 @app.post("/menu")
-def create_menu_item(req: CreateMenuItemRequest):
+async def create_menu_item(req: CreateMenuItemRequest):
     mi = MenuItem(**req.model_dump())
-    mid = create_document("menuitem", mi)
+    mid = await create_document("menuitem", mi)
     audit("create", "menuitem", mid, mi.model_dump(), cafe_id=mi.cafe_id)
     return {"menu_item_id": mid}
 
 
 # Orders
 @app.post("/orders")
-def create_order(req: CreateOrderRequest):
+async def create_order(req: CreateOrderRequest):
     if not req.items:
         raise HTTPException(400, "Order must have items")
 
-    # Build OrderItems from authoritative prices in MenuItem
+    # Build OrderItems from authoritative prices in MenuItem.
+    # Fetch all referenced items in one round-trip instead of one find per line.
+    ids = [oid(it["item_id"]) for it in req.items]
+    cursor = db.menuitem.find(
+        {"_id": {"$in": ids}, "cafe_id": req.cafe_id},
+        projection={"name": 1, "price": 1, "is_active": 1},
+    )
+    by_id = {doc["_id"]: doc async for doc in cursor}
+
+    # Money math in Decimal to avoid float accumulation error across lines.
     items: list[OrderItem] = []
-    subtotal = 0.0
-    for it in req.items:
-        item_doc = db.menuitem.find_one({"_id": oid(it["item_id"])})
+    subtotal = Decimal("0")
+    for it, item_id in zip(req.items, ids):
+        item_doc = by_id.get(item_id)
         if not item_doc or not item_doc.get("is_active", True):
             raise HTTPException(400, f"Invalid menu item: {it['item_id']}")
         qty = int(it.get("qty", 1))
         if qty <= 0:
             raise HTTPException(400, "Invalid quantity")
-        unit_price = float(item_doc["price"]) 
+        unit_price = _money(item_doc["price"])
         line_total = unit_price * qty
         subtotal += line_total
         items.append(OrderItem(
             item_id=str(item_doc["_id"]),
             name=item_doc["name"],
             qty=qty,
-            unit_price=unit_price,
-            total_price=line_total,
+            unit_price=float(unit_price),
+            total_price=float(line_total),
         ))
 
-    settings = db.settings.find_one({"cafe_id": req.cafe_id}) or {"tax_rate": 0.0}
-    tax = round(subtotal * float(settings.get("tax_rate", 0.0)), 2)
-    total = round(subtotal + tax, 2)
+    settings = await get_cached_settings(req.cafe_id)
+    tax = (subtotal * _money(settings.get("tax_rate", 0.0))).quantize(_CENTS, rounding=ROUND_HALF_UP)
+    total = (subtotal + tax).quantize(_CENTS, rounding=ROUND_HALF_UP)
 
     order = Order(
         cafe_id=req.cafe_id,
         session_id=req.session_id,
         station_id=req.station_id,
         items=items,
-        subtotal=subtotal,
-        tax=tax,
-        total=total,
+        subtotal=float(subtotal),
+        tax=float(tax),
+        total=float(total),
         status="pending",
         notes=req.notes,
     )
-    oid_new = create_document("order", order)
-    audit("create", "order", oid_new, order.model_dump(), cafe_id=req.cafe_id)
-    return {"order_id": oid_new, "total": total}
+    oid_new = await create_document("order", order)
+    # Summarize instead of re-dumping the whole items list into the audit log.
+    audit("create", "order", oid_new, {
+        "items_count": len(order.items),
+        "subtotal": order.subtotal,
+        "tax": order.tax,
+        "total": order.total,
+        "status": order.status,
+    }, cafe_id=req.cafe_id)
+    return {"order_id": oid_new, "total": float(total)}
 
 
 @app.post("/orders/status")
-def update_order_status(req: UpdateOrderStatusRequest):
-    o = db.order.find_one({"_id": oid(req.order_id)})
+async def update_order_status(req: UpdateOrderStatusRequest):
+    order_id = oid(req.order_id)
+    o = await db.order.find_one({"_id": order_id})
     if not o:
         raise HTTPException(404, "Order not found")
-    db.order.update_one({"_id": oid(req.order_id)}, {"$set": {"status": req.status, "updated_at": datetime.now(timezone.utc)}})
+    await db.order.update_one({"_id": order_id}, {"$set": {"status": req.status, "updated_at": now_utc()}})
     audit("update", "order", req.order_id, {"status": req.status}, cafe_id=o.get("cafe_id"))
     return {"ok": True}
 
 
 @app.get("/orders/pending")
-def fetch_pending_orders(cafe_id: Optional[str] = None):
+async def fetch_pending_orders(cafe_id: Optional[str] = None):
     q = {"status": {"$in": ["pending", "preparing"]}}
     if cafe_id:
         q["cafe_id"] = cafe_id
-    items = list(db.order.find(q).sort("created_at", -1).limit(100))
-    for x in items:
-        x["_id"] = str(x["_id"]) 
-    return items
+    projection = {
+        "cafe_id": 1, "session_id": 1, "station_id": 1, "status": 1, "items": 1,
+        "subtotal": 1, "tax": 1, "total": 1, "notes": 1, "created_at": 1,
+    }
+    kwargs = {"batchSize": 100}
+    if cafe_id:
+        kwargs["hint"] = {"cafe_id": 1, "status": 1, "created_at": -1}
+    return stream_json_array(db.order.aggregate([
+        {"$match": q},
+        {"$sort": {"created_at": -1}},
+        {"$limit": 100},
+        {"$project": projection},
+        {"$addFields": {"_id": {"$toString": "$_id"}}},
+    ], **kwargs))
 
 
 # Payments / Checkout
-@app.post("/checkout")
-def checkout(req: CheckoutRequest):
-    # Basic idempotency: if payment with idempotency_key exists and success, return it
-    existing = db.payment.find_one({"idempotency_key": req.idempotency_key, "status": "success"})
-    if existing:
-        return {"payment_id": str(existing["_id"]), "status": "success"}
+async def _apply_checkout_writes(req: CheckoutRequest, payment_doc: dict, s=None):
+    """Insert the payment and apply session/station/order updates.
 
+    Runs inside a transaction when one is passed via ``s``; audits are queued
+    either way and never join the transaction."""
+    result = await db.payment.insert_one(payment_doc, session=s)
+    pid = str(result.inserted_id)
+
+    # If closing a session, mark ended and free station (read+end in one round-trip)
+    if req.session_id:
+        sess = await db.session.find_one_and_update(
+            {"_id": oid(req.session_id), "status": {"$ne": "ended"}},
+            {"$set": {"status": "ended", "ended_at": now_utc()}},
+            session=s,
+        )
+        if sess:
+            await db.station.update_one(
+                {"_id": oid(sess["station_id"])},
+                {"$set": {"status": "available", "current_session_id": None}},
+                session=s,
+            )
+            audit("update", "session", req.session_id, {"status": "ended"}, cafe_id=sess.get("cafe_id"))
+
+    if req.order_id:
+        await db.order.update_one({"_id": oid(req.order_id)}, {"$set": {"status": "served"}}, session=s)
+        audit("update", "order", req.order_id, {"status": "served"})
+
+    return pid
+
+
+@app.post("/checkout")
+async def checkout(req: CheckoutRequest):
     payment = Payment(
         cafe_id=req.cafe_id,
         order_id=req.order_id,
@@ -275,19 +569,21 @@ def checkout(req: CheckoutRequest):
         status="success",
         idempotency_key=req.idempotency_key,
     )
-    pid = create_document("payment", payment)
+    payment_doc = payment.model_dump()
+    payment_doc["created_at"] = payment_doc["updated_at"] = now_utc()
 
-    # If closing a session, mark ended and free station
-    if req.session_id:
-        sess = db.session.find_one({"_id": oid(req.session_id)})
-        if sess and sess.get("status") != "ended":
-            db.session.update_one({"_id": oid(req.session_id)}, {"$set": {"status": "ended", "ended_at": now_iso()}})
-            db.station.update_one({"_id": oid(sess["station_id"])}, {"$set": {"status": "available", "current_session_id": None}})
-            audit("update", "session", req.session_id, {"status": "ended"}, cafe_id=sess.get("cafe_id"))
-
-    if req.order_id:
-        db.order.update_one({"_id": oid(req.order_id)}, {"$set": {"status": "served"}})
-        audit("update", "order", req.order_id, {"status": "served"})
+    # Insert-first idempotency: the unique index on idempotency_key rejects
+    # duplicates atomically, so retries cost one round-trip and can't race.
+    try:
+        if _txn_supported:
+            async with await client.start_session() as s:
+                async with s.start_transaction():
+                    pid = await _apply_checkout_writes(req, payment_doc, s)
+        else:
+            pid = await _apply_checkout_writes(req, payment_doc)
+    except DuplicateKeyError:
+        existing = await db.payment.find_one({"idempotency_key": req.idempotency_key})
+        return {"payment_id": str(existing["_id"]), "status": existing.get("status", "success")}
 
     audit("create", "payment", pid, payment.model_dump(), cafe_id=req.cafe_id)
     return {"payment_id": pid, "status": "success"}
@@ -295,43 +591,51 @@ def checkout(req: CheckoutRequest):
 
 # Settings
 @app.get("/settings")
-def get_settings(cafe_id: str):
-    s = db.settings.find_one({"cafe_id": cafe_id})
+async def get_settings(cafe_id: str):
+    s = await db.settings.find_one({"cafe_id": cafe_id})
     if not s:
         # default
         s = Settings(cafe_id=cafe_id, currency="INR", tax_rate=0.05, service_charge_rate=0.0).model_dump()
-        create_document("settings", s)
+        await create_document("settings", s)
     s["_id"] = str(s.get("_id", ""))
     return s
 
 
 @app.post("/settings")
-def update_settings(s: Settings):
-    existing = db.settings.find_one({"cafe_id": s.cafe_id})
+async def update_settings(s: Settings):
+    existing = await db.settings.find_one({"cafe_id": s.cafe_id})
     if existing:
-        db.settings.update_one({"_id": existing["_id"]}, {"$set": s.model_dump()})
+        await db.settings.update_one({"_id": existing["_id"]}, {"$set": s.model_dump()})
         sid = str(existing["_id"])
     else:
-        sid = create_document("settings", s)
+        sid = await create_document("settings", s)
+    _settings_cache.pop(s.cafe_id, None)
     audit("update", "settings", sid, s.model_dump(), cafe_id=s.cafe_id)
     return {"ok": True}
 
 
 # Minimal dashboard stats
 @app.get("/dashboard/stats")
-def fetch_dashboard_stats(cafe_id: Optional[str] = None):
+async def fetch_dashboard_stats(cafe_id: Optional[str] = None):
     q = {"cafe_id": cafe_id} if cafe_id else {}
-    total_orders = db.order.count_documents(q)
-    total_sessions = db.session.count_documents(q)
-    total_payments = db.payment.count_documents(q)
-    revenue = 0.0
-    for p in db.payment.find(q):
-        revenue += float(p.get("amount", 0))
+    # Revenue and payment count are grouped server-side in one aggregate
+    # instead of streaming every payment document over the wire; the counts
+    # and the aggregate run concurrently so the handler pays one round-trip
+    # of latency, not four.
+    orders, sessions, grouped = await asyncio.gather(
+        db.order.count_documents(q),
+        db.session.count_documents(q),
+        db.payment.aggregate([
+            {"$match": q},
+            {"$group": {"_id": None, "revenue": {"$sum": "$amount"}, "count": {"$sum": 1}}},
+        ]).to_list(length=1),
+    )
+    pay = grouped[0] if grouped else {"revenue": 0.0, "count": 0}
     return {
-        "orders": total_orders,
-        "sessions": total_sessions,
-        "payments": total_payments,
-        "revenue": round(revenue, 2),
+        "orders": orders,
+        "sessions": sessions,
+        "payments": pay["count"],
+        "revenue": round(float(pay["revenue"]), 2),
     }
 
 
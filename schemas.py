@@ -4,21 +4,33 @@ Database Schemas (MongoDB via Pydantic)
 Each Pydantic model corresponds to a MongoDB collection (lowercased model name).
 Use these models for validation at API boundaries.
 """
+from datetime import datetime
 from typing import List, Optional, Literal
-from pydantic import BaseModel, Field, EmailStr, conint, confloat
+from pydantic import BaseModel, ConfigDict, Field, EmailStr, conint, confloat
+
+
+class StrictModel(BaseModel):
+    """Shared config for all schemas.
+
+    Models here are built once per request and dumped, never mutated, so
+    assignment validation stays off and instances are frozen; unknown fields
+    are rejected rather than silently carried along.
+    """
+    model_config = ConfigDict(extra="forbid", frozen=True, validate_assignment=False)
+
 
 # Core domain schemas
-class Cafe(BaseModel):
+class Cafe(StrictModel):
     name: str
     address: Optional[str] = None
     timezone: Optional[str] = "UTC"
     is_active: bool = True
 
-class Role(BaseModel):
+class Role(StrictModel):
     name: Literal["admin", "cashier", "chef", "manager"]
     description: Optional[str] = None
 
-class User(BaseModel):
+class User(StrictModel):
     email: EmailStr
     password_hash: str
     name: str
@@ -26,24 +38,24 @@ class User(BaseModel):
     cafe_id: Optional[str] = None
     is_active: bool = True
 
-class Station(BaseModel):
+class Station(StrictModel):
     cafe_id: str
     name: str
     status: Literal["available", "in-use", "offline", "maintenance"] = "available"
     current_session_id: Optional[str] = None
 
-class Session(BaseModel):
+class Session(StrictModel):
     cafe_id: str
     station_id: str
     user_id: Optional[str] = None  # staff who started
     customer_name: Optional[str] = None
     status: Literal["active", "ended", "paused"] = "active"
-    started_at: Optional[str] = None
-    ended_at: Optional[str] = None
+    started_at: Optional[datetime] = None
+    ended_at: Optional[datetime] = None
     duration_minutes: Optional[int] = None
     total_amount: Optional[confloat(ge=0)] = 0.0
 
-class MenuItem(BaseModel):
+class MenuItem(StrictModel):
     cafe_id: str
     name: str
     category: Optional[str] = None
@@ -51,21 +63,21 @@ class MenuItem(BaseModel):
     sku: Optional[str] = None
     is_active: bool = True
 
-class Inventory(BaseModel):
+class Inventory(StrictModel):
     cafe_id: str
     sku: str
     name: str
     qty: conint(ge=0)
     min_qty: Optional[conint(ge=0)] = 0
 
-class OrderItem(BaseModel):
+class OrderItem(StrictModel):
     item_id: str  # MenuItem _id
     name: str
     qty: conint(gt=0)
     unit_price: confloat(ge=0)
     total_price: confloat(ge=0)
 
-class Order(BaseModel):
+class Order(StrictModel):
     cafe_id: str
     session_id: Optional[str] = None
     station_id: Optional[str] = None
@@ -76,7 +88,7 @@ class Order(BaseModel):
     total: confloat(ge=0) = 0.0
     notes: Optional[str] = None
 
-class Payment(BaseModel):
+class Payment(StrictModel):
     cafe_id: str
     order_id: Optional[str] = None
     session_id: Optional[str] = None
@@ -86,26 +98,30 @@ class Payment(BaseModel):
     idempotency_key: Optional[str] = None
     reference: Optional[str] = None
 
-class Settings(BaseModel):
+class Settings(StrictModel):
+    # Clients may POST back the document returned by GET /settings, which
+    # carries _id and timestamps — ignore extras instead of rejecting them.
+    model_config = ConfigDict(extra="ignore", frozen=True, validate_assignment=False)
+
     cafe_id: str
     currency: str = "INR"
     tax_rate: confloat(ge=0) = 0.0
     service_charge_rate: confloat(ge=0) = 0.0
 
-class KDSUpdate(BaseModel):
+class KDSUpdate(StrictModel):
     cafe_id: str
     order_id: str
     status: Literal["pending", "preparing", "ready", "served"]
     note: Optional[str] = None
 
-class Notification(BaseModel):
+class Notification(StrictModel):
     cafe_id: str
     type: Literal["order", "session", "payment", "system"]
     title: str
     body: Optional[str] = None
     read: bool = False
 
-class AuditLog(BaseModel):
+class AuditLog(StrictModel):
     user_id: Optional[str] = None
     cafe_id: Optional[str] = None
     action: str
@@ -114,36 +130,36 @@ class AuditLog(BaseModel):
     payload: Optional[dict] = None
 
 # Request DTOs
-class RegisterRequest(BaseModel):
+class RegisterRequest(StrictModel):
     email: EmailStr
     name: str
     password: str
     role: Literal["admin", "cashier", "chef", "manager"] = "cashier"
 
-class LoginRequest(BaseModel):
+class LoginRequest(StrictModel):
     email: EmailStr
     password: str
 
-class StartSessionRequest(BaseModel):
+class StartSessionRequest(StrictModel):
     cafe_id: str
     station_id: str
     customer_name: Optional[str] = "Walk-in"
 
-class EndSessionRequest(BaseModel):
+class EndSessionRequest(StrictModel):
     session_id: str
 
-class CreateOrderRequest(BaseModel):
+class CreateOrderRequest(StrictModel):
     cafe_id: str
     session_id: Optional[str] = None
     station_id: Optional[str] = None
     items: List[dict]
     notes: Optional[str] = None
 
-class UpdateOrderStatusRequest(BaseModel):
+class UpdateOrderStatusRequest(StrictModel):
     order_id: str
     status: Literal["pending", "preparing", "ready", "served", "canceled"]
 
-class CheckoutRequest(BaseModel):
+class CheckoutRequest(StrictModel):
     cafe_id: str
     session_id: Optional[str] = None
     order_id: Optional[str] = None
@@ -151,13 +167,13 @@ class CheckoutRequest(BaseModel):
     method: Literal["cash", "upi", "card"]
     idempotency_key: str
 
-class CreateMenuItemRequest(BaseModel):
+class CreateMenuItemRequest(StrictModel):
     cafe_id: str
     name: str
     price: confloat(ge=0)
     category: Optional[str] = None
     sku: Optional[str] = None
 
-class UpdateStationStatusRequest(BaseModel):
+class UpdateStationStatusRequest(StrictModel):
     station_id: str
     status: Literal["available", "in-use", "offline", "maintenance"]